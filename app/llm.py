@@ -1,5 +1,6 @@
 from __future__ import annotations
-import os, json, re, httpx, pathlib
+import os, json, re, httpx, pathlib, atexit
+import orjson
 
 CHAT_BASE = os.getenv("CHAT_BASE")
 CHAT_PATH = os.getenv("CHAT_PATH", "/v1/chat/completions")
@@ -10,55 +11,80 @@ ART_DIR = os.environ.get("ART_DIR") or ("/tmp/artifacts" if os.environ.get("VERC
 ART = pathlib.Path(ART_DIR); ART.mkdir(exist_ok=True, parents=True)
 LAST = ART / "llm_last.txt"
 
+# Endpoint URLs and headers are fixed for the process; compute them once
+_BASE = (CHAT_BASE or "").rstrip("/")
+_CHAT_URL = _BASE + (CHAT_PATH or "/v1/chat/completions") if _BASE else None
+_COMP_URL = _BASE + "/v1/completions" if _BASE else None
+_HEADERS = {"Authorization": f"Bearer {API_KEY}", "Content-Type": "application/json"} if API_KEY else None
+
+_FALLBACK = {
+    "title": "Tiny Fallback Quiz",
+    "questions": [
+        {"type":"truefalse","prompt":"This quiz is generated without an LLM.","answer":True,"points":1},
+        {"type":"short","prompt":"Name one concept from the provided materials.","points":1},
+    ],
+}
+
+# One keep-alive client for the process so each call skips the TCP/TLS handshake
+_LLM_CLIENT = httpx.Client(
+    headers=_HEADERS,
+    timeout=httpx.Timeout(60.0, connect=5.0),
+    http2=True,
+    limits=httpx.Limits(max_keepalive_connections=4),
+)
+atexit.register(_LLM_CLIENT.close)
+
+_FENCE_OPEN = re.compile(r"^```(?:json)?", re.I)
+_FENCE_CLOSE = re.compile(r"```$")
+_TRAILING_COMMA = re.compile(r",\s*([}\]])")
+_JSON_OBJ = re.compile(r"\{.*\}", re.S)
+_PY_LIT = re.compile(r"\b(True|False|None)\b")
+_PY_LIT_MAP = {"True": "true", "False": "false", "None": "null"}
+
 def _strip(txt: str) -> str:
     txt = txt.strip()
-    txt = re.sub(r"^```(?:json)?", "", txt, flags=re.I).strip()
-    txt = re.sub(r"```$", "", txt).strip()
+    txt = _FENCE_OPEN.sub("", txt).strip()
+    txt = _FENCE_CLOSE.sub("", txt).strip()
     return txt
 
+def _loads(s: str):
+    try:
+        return orjson.loads(s)
+    except orjson.JSONDecodeError:
+        # orjson rejects a few things stdlib json tolerates (NaN, lone surrogates)
+        return json.loads(s)
+
 def _coerce_json2(txt: str) -> dict:
     s = _strip(txt)
-    s = s.replace("True","true").replace("False","false").replace("None","null")
-    s = re.sub(r",\s*([}\]])", r"\1", s)
+    s = _PY_LIT.sub(lambda m: _PY_LIT_MAP[m.group(0)], s)
+    s = _TRAILING_COMMA.sub(r"\1", s)
     try:
-        return json.loads(s)
+        return _loads(s)
     except Exception:
-        m = re.search(r"\{.*\}", s, flags=re.S)
+        m = _JSON_OBJ.search(s)
         if m:
-            return json.loads(m.group(0))
+            return _loads(m.group(0))
         raise ValueError("Could not parse JSON from model output")
 
 def chat_json(system: str, user: str, max_tokens=2000, temperature=0.15) -> dict:
-    if not CHAT_BASE or not API_KEY:
-        fallback = {
-            "title": "Tiny Fallback Quiz",
-            "questions": [
-                {"type":"truefalse","prompt":"This quiz is generated without an LLM.","answer":True,"points":1},
-                {"type":"short","prompt":"Name one concept from the provided materials.","points":1},
-            ],
-        }
+    if not _CHAT_URL or not _HEADERS:
         LAST.write_text("FALLBACK MODE (missing CHAT_BASE/API_KEY)\n", encoding="utf-8")
-        return fallback
+        return _FALLBACK  # shared; callers only read it
 
-    url = CHAT_BASE.rstrip("/") + (CHAT_PATH or "/v1/chat/completions")
-    headers = {"Authorization": f"Bearer {API_KEY}", "Content-Type": "application/json"}
     payload = {"model": MODEL_NAME, "messages":[{"role":"system","content":system},{"role":"user","content":user}],
                "max_tokens": max_tokens, "temperature": temperature}
-    with httpx.Client(timeout=60) as s:
-        r = s.post(url, json=payload, headers=headers)
+    r = _LLM_CLIENT.post(_CHAT_URL, content=orjson.dumps(payload))
     r.raise_for_status()
-    data = r.json()
+    data = orjson.loads(r.content)
     txt = ""
     if data.get("choices"):
         ch = data["choices"][0]
         txt = ch.get("message",{}).get("content") or ch.get("text","")
     if not txt:
         # /v1/completions fallback
-        comp = CHAT_BASE.rstrip("/") + "/v1/completions"
-        with httpx.Client(timeout=60) as s:
-            r2 = s.post(comp, json={"model":MODEL_NAME,"prompt":f"{system}\n\nUSER:\n{user}\nReturn JSON only.","max_tokens":max_tokens,"temperature":temperature}, headers=headers)
+        r2 = _LLM_CLIENT.post(_COMP_URL, content=orjson.dumps({"model":MODEL_NAME,"prompt":f"{system}\n\nUSER:\n{user}\nReturn JSON only.","max_tokens":max_tokens,"temperature":temperature}))
         r2.raise_for_status()
-        data = r2.json()
+        data = orjson.loads(r2.content)
         txt = data.get("choices",[{}])[0].get("text","")
     LAST.write_text(txt or "", encoding="utf-8")
     return _coerce_json2(txt or "{}")
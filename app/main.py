@@ -1,27 +1,48 @@
 from __future__ import annotations
-import os, re, json, pathlib, traceback, random
-from typing import List, Optional, Tuple, Any, Dict
+import os, re, json, pathlib, traceback, random, asyncio
+from contextvars import ContextVar
+from http.cookiejar import CookieJar, DefaultCookiePolicy
+from functools import lru_cache
+from typing import Iterable, List, Optional, Sequence, Tuple, Any, Dict
 from collections import Counter
 
 from fastapi import FastAPI, HTTPException
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.staticfiles import StaticFiles
-from fastapi.responses import FileResponse, JSONResponse
+from fastapi.responses import FileResponse, ORJSONResponse
 from starlette.requests import Request
 from pydantic import BaseModel
+import httpx
 
-from app.models import Quiz, Midterm
+from app.models import Quiz, Midterm, Question, MCQ, TrueFalse, FillBlank
 from app.llm import chat_json
 from app.canvas import CanvasClient
 
 ART_DIR = os.environ.get("ART_DIR") or ("/tmp/artifacts" if os.environ.get("VERCEL") else "artifacts")
 ART = pathlib.Path(ART_DIR); ART.mkdir(exist_ok=True, parents=True)
 COLLECT_LOG = ART / "collect_last.txt"
+# Debug-only artifacts; off by default so request handlers never block on disk
+DEBUG_COLLECT = bool(os.environ.get("DEBUG_COLLECT"))
+DEBUG_ERRORS = bool(os.environ.get("DEBUG_ERRORS"))
 
-app = FastAPI()
+app = FastAPI(default_response_class=ORJSONResponse)
 app.add_middleware(CORSMiddleware, allow_origins=["*"], allow_methods=["*"], allow_headers=["*"])
 app.mount("/static", StaticFiles(directory="static"), name="static")
 
+# One pooled connection set to Canvas for the whole worker; per-request clients only carry creds.
+# The jar refuses every cookie so one user's Canvas session never rides along on another's request.
+CANVAS_HTTP = httpx.AsyncClient(
+    http2=True,
+    limits=httpx.Limits(max_connections=100, max_keepalive_connections=20),
+    timeout=30,
+    follow_redirects=True,
+    cookies=CookieJar(DefaultCookiePolicy(allowed_domains=[])),
+)
+
+@app.on_event("shutdown")
+async def _close_canvas_http():
+    await CANVAS_HTTP.aclose()
+
 @app.get("/", include_in_schema=False)
 def root():
     return FileResponse("static/index.html")
@@ -33,25 +54,27 @@ def health():
 @app.exception_handler(Exception)
 async def all_exceptions_handler(request: Request, exc: Exception):
     tb = "".join(traceback.format_exception(type(exc), exc, exc.__traceback__))
-    (ART / "server_errors.log").write_text(tb, encoding="utf-8")
-    return JSONResponse(status_code=500, content={"detail": f"{type(exc).__name__}: {str(exc)}"})
+    if DEBUG_ERRORS:
+        await asyncio.to_thread((ART / "server_errors.log").write_text, tb, encoding="utf-8")
+    return ORJSONResponse(status_code=500, content={"detail": f"{type(exc).__name__}: {str(exc)}"})
 
 # -------------------- State / helpers --------------------
-STATE: Dict[str, Any] = {"client": None}
+# Scoped to the current request, so concurrent users never see each other's token
+current_client: ContextVar[Optional[CanvasClient]] = ContextVar("current_client", default=None)
 
 def _update_state_if_provided(base: Optional[str], token: Optional[str]):
     b = (base or "").strip() or "https://canvas.instructure.com/"
     t = (token or "").strip()
     if t:
-        STATE["client"] = CanvasClient(b, t)
+        current_client.set(CanvasClient(b, t, http=CANVAS_HTTP))
 
 def _client_or_401() -> CanvasClient:
-    client = STATE.get("client")
+    client = current_client.get()
     if not client:
         raise HTTPException(status_code=401, detail="Authenticate first.")
     return client
 
-def _resolve_course_id(client: CanvasClient, cid: Optional[int]) -> int:
+async def _resolve_course_id(client: CanvasClient, cid: Optional[int]) -> int:
     if cid: return int(cid)
     courses = await client.list_courses()
     if not courses:
@@ -77,7 +100,6 @@ class GenerateQuizBody(BaseModel):
     file_ids: Optional[List[int]] = None
     assignment_ids: Optional[List[int]] = None
     quiz_count: Optional[int] = 20
-_AUTH: dict = {}  # in-memory creds (stateless on serverless)
 
 class GenerateMidtermBody(BaseModel):
     canvas_base_url: Optional[str] = None
@@ -103,52 +125,63 @@ class PublishMidtermBody(BaseModel):
     settings: Optional[Dict[str, Any]] = None
 
 # -------------------- Text cleaning --------------------
-_BULLETS = r"[•·▪︎►▶▪●◦∙•♦■□–—\-•\*]+"
+# Bullet glyphs, dashes and nbsp -> space in one C-level pass (runs collapse later)
+_BULLET_TABLE = str.maketrans({ch: " " for ch in "•·▪\ufe0e►▶●◦∙♦■□–—-*\u00a0"})
+_RE_FILEHDR = re.compile(r"^#+\s*File:\s*\d+\s*$", re.M)
+_RE_ENDPUNCT = re.compile(r"[.!?]([\"')\]]+)?\s*$")
+_RE_LOWER_START = re.compile(r"[a-z0-9]")
+_RE_HSPACE = re.compile(r"[ \t]+")
+_RE_PARA = re.compile(r"\n{2,}")
+_RE_MULTISP = re.compile(r"[ \t]{2,}")
+_RE_NL3 = re.compile(r"\n{3,}")
+_RE_WS = re.compile(r"\s+")
+_RE_SENT = re.compile(r"(?<=[.!?])\s+")
+_RE_WORD = re.compile(r"[A-Za-z][A-Za-z\-']{2,}")
+_RE_CAP = re.compile(r"\b([A-Z][a-zA-Z]{2,})\b")
+_RE_TOK = re.compile(r"[A-Za-z][A-Za-z\-']+")
+_match_text = re.Match.group  # m -> m.group(), mappable in C
+
+# Join hard-wrapped lines (PDF artifacts): newline not ending a sentence -> space
+# Preserve paragraph breaks (double newline).
+def _join_wraps(block: str) -> str:
+    lines = [ln.strip() for ln in block.split("\n")]  # strip each line once
+    last = len(lines) - 1
+    out = []
+    for i, ln in enumerate(lines):
+        if not ln:
+            continue
+        nxt = lines[i+1] if i < last else ""
+        # If line ends without end punctuation and next line starts lowercase/alnum, join
+        if (not _RE_ENDPUNCT.search(ln)) and nxt and _RE_LOWER_START.match(nxt):
+            out.append(ln + " ")
+        else:
+            out.append(ln + "\n")
+    return _RE_HSPACE.sub(" ", "".join(out))
+
+@lru_cache(maxsize=32)
 def _cleanup_text(s: str) -> str:
     if not s: return ""
     t = s
 
     # Remove artificial file headers injected into corpus, keep content
-    t = re.sub(r"^#+\s*File:\s*\d+\s*$", "", t, flags=re.M)
+    t = _RE_FILEHDR.sub("", t)
 
     # Normalize bullets and weird whitespace
-    t = re.sub(_BULLETS, " ", t)
-    t = t.replace("\u00a0", " ")  # nbsp
-
-    # Join hard-wrapped lines (PDF artifacts): newline not ending a sentence -> space
-    # Preserve paragraph breaks (double newline).
-    def join_wraps(block: str) -> str:
-        lines = block.split("\n")
-        out = []
-        for i, ln in enumerate(lines):
-            ln = ln.strip()
-            if not ln:
-                out.append("")
-                continue
-            if i+1 < len(lines):
-                nxt = lines[i+1].strip()
-            else:
-                nxt = ""
-            # If line ends without end punctuation and next line starts lowercase/alnum, join
-            if (not re.search(r"[.!?]([\"')\]]+)?\s*$", ln)) and nxt and re.match(r"[a-z0-9]", nxt):
-                out.append(ln + " ")
-            else:
-                out.append(ln + "\n")
-        joined = "".join(out)
-        return re.sub(r"[ \t]+", " ", joined)
+    t = t.translate(_BULLET_TABLE)
+
     # Work per paragraph block to keep structure
-    blocks = re.split(r"\n{2,}", t)
-    t = "\n\n".join(join_wraps(b).strip() for b in blocks if b.strip())
+    blocks = _RE_PARA.split(t)
+    t = "\n\n".join(_join_wraps(b).strip() for b in blocks if b.strip())
 
     # Collapse excessive whitespace
-    t = re.sub(r"[ \t]{2,}", " ", t)
-    t = re.sub(r"\n{3,}", "\n\n", t)
+    t = _RE_MULTISP.sub(" ", t)
+    t = _RE_NL3.sub("\n\n", t)
     return t.strip()
 
 # -------------------- Question normalization --------------------
 def _normalize_question(q: Dict[str, Any]) -> Dict[str, Any]:
     t = str(q.get("type") or "").strip().lower()
-    prompt = re.sub(r"\s+", " ", str(q.get("prompt") or "").strip())
+    prompt = _RE_WS.sub(" ", str(q.get("prompt") or "").strip())
     points = int(q.get("points") or 1)
     if not prompt:
         return {"type":"short","prompt":"Explain one key concept from the materials.","points":1}
@@ -183,6 +216,15 @@ def _normalize_question(q: Dict[str, Any]) -> Dict[str, Any]:
 
     return {"type":"short","prompt":prompt,"points":points}
 
+def _dedup_questions(qs: Iterable[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """Keep the first question per (type, stripped prompt); drop prompt-less ones."""
+    seen: Dict[Tuple[Any, str], Dict[str, Any]] = {}
+    for q in qs:
+        prompt = (q.get("prompt") or "").strip()
+        if prompt:
+            seen.setdefault((q.get("type"), prompt), q)
+    return list(seen.values())
+
 def _pack_questions(data: Dict[str, Any], default_title: str) -> Tuple[str, List[Dict[str, Any]]]:
     title = str(data.get("title") or default_title).strip()
     pool: List[Dict[str, Any]] = []
@@ -195,40 +237,43 @@ def _pack_questions(data: Dict[str, Any], default_title: str) -> Tuple[str, List
         pool = data
     elif isinstance(data, dict) and all(k in data for k in ("type","prompt")):
         pool = [data]
-    out: List[Dict[str, Any]] = []
-    seen = set()
-    for q in pool:
-        qq = _normalize_question(q)
-        key = (qq.get("type"), (qq.get("prompt") or "").strip())
-        if key[1] and key not in seen:
-            seen.add(key); out.append(qq)
-    return title or default_title, out
+    return title or default_title, _dedup_questions(_normalize_question(q) for q in pool)
 
 # -------------------- Offline generator (no LLM creds needed) --------------------
-_STOPWORDS = set("""
+_STOPWORDS = frozenset("""
 a an the and or but if then else for to in on at of by with from into over under through as is are was were be been being this that these those it its it's
 you your yours we us our they them their i me my mine he she his her hers which who whom whose what when where why how not no yes true false very more most
 """.split())
 
-def _keywords(text: str, k: int = 40) -> List[str]:
-    words = re.findall(r"[A-Za-z][A-Za-z\-']{2,}", text)
-    words = [w.lower() for w in words]
-    words = [w for w in words if w not in _STOPWORDS and not w.isdigit() and len(w) > 3]
-    cnt = Counter(words)
+# Memoized on the (hashable) text: retries and quiz+midterm runs over one selection reuse the work.
+# The Counter is shared between calls, so callers must only read it.
+@lru_cache(maxsize=32)
+def _keyword_counts(text: str) -> Counter:
+    # Lowercase once and let Counter tally in C, then filter the distinct words
+    # (a few hundred) instead of testing every token occurrence in Python.
+    # finditer feeds Counter lazily, so no token list the size of the corpus is built.
+    cnt = Counter(map(_match_text, _RE_WORD.finditer(text.lower())))
+    # tokens start with a letter, so there are no all-digit words to drop
+    for w in [w for w in cnt if len(w) <= 3 or w in _STOPWORDS]:
+        del cnt[w]
     # prefer mixed case occurrences (proper nouns) by boosting tokens that appear capitalized in original
-    caps = set(re.findall(r"\b([A-Z][a-zA-Z]{2,})\b", text))
-    for c in caps:
-        lc = c.lower()
-        if lc in cnt:
-            cnt[lc] += 2
-    return [w for w, _ in cnt.most_common(k)]
-
-def _pick_distractors(answer: str, vocab: List[str], n: int = 3) -> List[str]:
-    pool = [w for w in vocab if w != answer.lower()]
-    random.shuffle(pool)
+    caps_lc = {c.lower() for c in _RE_CAP.findall(text)}
+    for lc in caps_lc & cnt.keys():
+        cnt[lc] += 2
+    return cnt
+
+# Results are tuples so a cached value can never be mutated by a caller.
+@lru_cache(maxsize=32)
+def _keywords(text: str, k: int = 40) -> Tuple[str, ...]:
+    return tuple(w for w, _ in _keyword_counts(text).most_common(k))
+
+def _pick_distractors(answer: str, vocab: Sequence[str], n: int = 3) -> List[str]:
+    ans_l = answer.lower()
+    pool = [w for w in vocab if w.lower() != ans_l]
+    # sample is O(k); shuffling the whole pool only to keep n was wasted work
     out = []
-    for w in pool:
-        if w.lower() != answer.lower() and w not in out:
+    for w in random.sample(pool, min(len(pool), n*2)):
+        if w not in out:
             out.append(w)
         if len(out) >= n: break
     if len(out) < n:
@@ -237,15 +282,46 @@ def _pick_distractors(answer: str, vocab: List[str], n: int = 3) -> List[str]:
         out = out[:n]
     return out
 
-def _sentences(text: str) -> List[str]:
+@lru_cache(maxsize=32)
+def _sentences(text: str) -> Tuple[Tuple[str, int], ...]:
+    """(sentence, word_count) pairs for sentences of 5+ words."""
     # split on sentence boundaries but keep long lines together
-    parts = re.split(r"(?<=[.!?])\s+", text)
-    parts = [re.sub(r"\s+", " ", p).strip() for p in parts]
-    return [p for p in parts if len(p.split()) >= 5]
-
-def _offline_generate(corpus: str, n: int) -> List[Dict[str, Any]]:
-    text = _cleanup_text(corpus)
-    sents = _sentences(text)[:200]
+    out = []
+    for p in _RE_SENT.split(text):
+        p = _RE_WS.sub(" ", p).strip()
+        if not p: continue
+        wc = p.count(" ") + 1  # exact: whitespace is already collapsed to single spaces
+        if wc >= 5: out.append((p, wc))
+    return tuple(out)
+
+@lru_cache(maxsize=256)
+def _blank_pattern(word: str) -> re.Pattern:
+    return re.compile(r"\b" + re.escape(word) + r"\b", re.I)
+
+# crude negation: swap "is/are/can/will" with "is not/are not/cannot/will not" when possible
+_NEG_MAP = {"is": "is not", "are": "are not", "can": "cannot", "will": "will not", "does": "does not", "do": "do not"}
+_NEG_RE = re.compile(r"\b(is|are|can|will|does|do)\b", re.I)
+
+def _lazy_shuffle(rng: random.Random, items: Sequence[Any]) -> Iterable[Any]:
+    """Yield items in random order, one swap per draw (partial Fisher-Yates).
+
+    Loops that stop at a quota pay only for what they consume, yet can still
+    reach every item when many candidates get skipped.
+    """
+    pool = list(items)
+    for i in range(len(pool) - 1, -1, -1):
+        j = rng.randrange(i + 1)
+        pool[i], pool[j] = pool[j], pool[i]
+        yield pool[i]
+
+def _offline_generate(text: str, n: int) -> List[Dict[str, Any]]:
+    """Build questions from already-cleaned text (see _cleanup_text)."""
+    pairs = _sentences(text)[:200]
+    sents = [s for s, _ in pairs]
+    sent_wc = [wc for _, wc in pairs]
+    # tokenize each sentence once; the MCQ, TF and fill-blank loops all index into these
+    sent_toks = [_RE_TOK.findall(s) for s in sents]
+    sent_toks_l = [[t.lower() for t in ts] for ts in sent_toks]
     vocab = _keywords(text, k=80)
     rng = random.Random(42)
 
@@ -257,18 +333,23 @@ def _offline_generate(corpus: str, n: int) -> List[Dict[str, Any]]:
     out: List[Dict[str, Any]] = []
 
     # MCQs: choose a sentence with a salient keyword and blank it
-    candidates = [s for s in sents if any(k in s.lower() for k in vocab[:50])]
-    rng.shuffle(candidates)
-    for s in candidates:
-        toks = re.findall(r"[A-Za-z][A-Za-z\-']+", s)
-        toks_l = [t.lower() for t in toks]
+    # set intersection instead of 50 substring scans each; _RE_WORD matches are exactly the 3+ char tokens
+    vocab_set = set(vocab[:50])
+    candidates = [idx for idx, toks_l in enumerate(sent_toks_l)
+                  if not vocab_set.isdisjoint(t for t in toks_l if len(t) > 2)]
+    for idx in _lazy_shuffle(rng, candidates):
+        s, toks = sents[idx], sent_toks[idx]
+        tok_pos: Dict[str, int] = {}
+        for i, t in enumerate(sent_toks_l[idx]):
+            tok_pos.setdefault(t, i)  # first occurrence wins
         target = None
         for k in vocab:
-            if k in toks_l and len(k) > 3:
-                target = toks[toks_l.index(k)]
+            i = tok_pos.get(k)
+            if i is not None and len(k) > 3:
+                target = toks[i]
                 break
         if not target: continue
-        stem = re.sub(r"\b" + re.escape(target) + r"\b", "____", s, flags=re.I)
+        stem = _blank_pattern(target.lower()).sub("____", s)
         correct = target
         distractors = _pick_distractors(correct, vocab, 3)
         choices = [correct] + distractors
@@ -278,33 +359,25 @@ def _offline_generate(corpus: str, n: int) -> List[Dict[str, Any]]:
         if len(out) >= want_mcq: break
 
     # True/False: use declaratives; flip some with a subtle negation
-    tf_candidates = [s for s in sents if len(s.split()) <= 30]
-    rng.shuffle(tf_candidates)
-    for i, s in enumerate(tf_candidates):
+    tf_candidates = [s for s, wc in pairs if wc <= 30]
+    for i, s in enumerate(_lazy_shuffle(rng, tf_candidates)):
         make_false = (i % 3 == 0)  # ~33% false
         p = s
         ans = True
         if make_false:
-            # crude negation: swap "is/are/can/will" with "is not/are not/cannot/won't" when possible
-            repls = [
-                (r"\bis\b", "is not"), (r"\bare\b", "are not"),
-                (r"\bcan\b", "cannot"), (r"\bwill\b", "will not"),
-                (r"\bdoes\b", "does not"), (r"\bdo\b", "do not"),
-            ]
-            for pat, rep in repls:
-                if re.search(pat, p, flags=re.I):
-                    p = re.sub(pat, rep, p, flags=re.I); ans = False; break
+            neg, hits = _NEG_RE.subn(lambda m: _NEG_MAP[m.group(1).lower()], p, count=1)
+            if hits:
+                p, ans = neg, False
         out.append({"type":"truefalse","prompt":p,"answer":ans,"points":1})
         if sum(1 for q in out if q["type"]=="truefalse") >= want_tf: break
 
     # Fill-in-the-blank: blank a mid-sentence noun-ish token
-    fb_sents = [s for s in sents if 8 <= len(s.split()) <= 30]
-    rng.shuffle(fb_sents)
-    for s in fb_sents:
-        toks = re.findall(r"[A-Za-z][A-Za-z\-']+", s)
+    fb_sents = [i for i, wc in enumerate(sent_wc) if 8 <= wc <= 30]
+    for si in _lazy_shuffle(rng, fb_sents):
+        toks, toks_l = sent_toks[si], sent_toks_l[si]
         if len(toks) < 5: continue
         # pick a mid token that's not a stopword
-        idxs = [i for i,t in enumerate(toks[1:-1], start=1) if t.lower() not in _STOPWORDS and len(t) > 3]
+        idxs = [i for i in range(1, len(toks) - 1) if toks_l[i] not in _STOPWORDS and len(toks[i]) > 3]
         if not idxs: continue
         idx = rng.choice(idxs)
         ans = toks[idx]
@@ -317,19 +390,29 @@ def _offline_generate(corpus: str, n: int) -> List[Dict[str, Any]]:
         out.append({"type":"short","prompt":f"In 1–2 sentences, explain '{kw}' in the context of the materials.","points":1})
         if sum(1 for q in out if q["type"]=="short") >= want_sh: break
 
-    # Deduplicate by (type,prompt)
-    seen=set(); ded=[]
-    for q in out:
-        key=(q["type"], q["prompt"])
-        if key not in seen:
-            seen.add(key); ded.append(q)
+    ded = _dedup_questions(out)
     # Top up if needed
     while len(ded) < n:
         ded.append({"type":"short","prompt":"Name one concrete fact from the materials and why it matters.","points":1})
     return ded[:n]
 
 # -------------------- Collection --------------------
-def _collect_content(client: CanvasClient, course_id: int,
+def _write_collect_log(module_ids, pset, fset, aset, titles: List[str], warns: List[str], raw_len: int, clean_len: int) -> None:
+    # Log what we ingested
+    with COLLECT_LOG.open("w", encoding="utf-8") as f:
+        f.write("=== COLLECTION LOG ===\n")
+        f.write(f"Modules: {sorted(module_ids or [])}\n")
+        f.write(f"Pages:   {sorted(pset)}\n")
+        f.write(f"Files:   {sorted(fset)}\n")
+        f.write(f"Assigns: {sorted(aset)}\n")
+        f.write(f"SOURCES ({len(titles)}):\n")
+        for t in titles: f.write(f"- {t}\n")
+        f.write(f"\nTOTAL CORPUS CHARS (raw/clean): {raw_len} / {clean_len}\n")
+        if warns:
+            f.write("\nWARNINGS:\n")
+            for w in warns: f.write(f"- {w}\n")
+
+async def _collect_content(client: CanvasClient, course_id: int,
                      module_ids: Optional[List[int]],
                      page_urls: Optional[List[str]],
                      file_ids: Optional[List[int]],
@@ -342,7 +425,7 @@ def _collect_content(client: CanvasClient, course_id: int,
 
     if module_ids:
         try:
-            all_mods = client.list_modules(course_id)
+            all_mods = await client.list_modules(course_id)
             wanted = set(module_ids)
             for m in all_mods:
                 if m["id"] in wanted:
@@ -353,67 +436,136 @@ def _collect_content(client: CanvasClient, course_id: int,
         except Exception as e:
             warns.append(f"Module expansion error: {e}")
 
+    # Fetch every selected item concurrently; failures become warnings, not aborts
+    sources: List[Tuple[str, Any]] = (
+        [("Page", u) for u in sorted(pset)]
+        + [("File", fid) for fid in sorted(fset)]
+        + [("Assignment", aid) for aid in sorted(aset)]
+    )
+    fetches = []
+    for kind, key in sources:
+        if kind == "Page": fetches.append(client.get_page_body(course_id, key))
+        elif kind == "File": fetches.append(client.get_file_text(int(key)))
+        else: fetches.append(client.get_assignment_text(course_id, int(key)))
+    results = await asyncio.gather(*fetches, return_exceptions=True)
+
     parts: List[str] = []
-    for u in sorted(pset):
-        try:
-            txt = client.get_page_body(course_id, u)
-            titles.append(f"Page: {u}")
-            if txt: parts.append(f"### Page: {u}\n{txt}")
-        except Exception as e:
-            warns.append(f"Page {u}: {e}")
-    for fid in sorted(fset):
-        try:
-            txt, w = client.get_file_text(int(fid))
-            if w: warns.append(w)
-            titles.append(f"File: {fid}")
-            if txt: parts.append(f"### File: {fid}\n{txt}")
-        except Exception as e:
-            warns.append(f"File {fid}: {e}")
-    for aid in sorted(aset):
-        try:
-            txt = client.get_assignment_text(course_id, int(aid))
-            titles.append(f"Assignment: {aid}")
-            if txt: parts.append(f"### Assignment: {aid}\n{txt}")
-        except Exception as e:
-            warns.append(f"Assignment {aid}: {e}")
+    for (kind, key), txt in zip(sources, results):
+        if isinstance(txt, BaseException):
+            warns.append(f"{kind} {key}: {txt}")
+            continue
+        titles.append(f"{kind}: {key}")
+        if txt: parts.append(f"### {kind}: {key}\n{txt}")
 
     raw = "\n\n".join(parts).strip()
     corpus = _cleanup_text(raw)
 
-    # Log what we ingested
-    with COLLECT_LOG.open("w", encoding="utf-8") as f:
-        f.write("=== COLLECTION LOG ===\n")
-        f.write(f"Modules: {sorted(module_ids or [])}\n")
-        f.write(f"Pages:   {sorted(pset)}\n")
-        f.write(f"Files:   {sorted(fset)}\n")
-        f.write(f"Assigns: {sorted(aset)}\n")
-        f.write(f"SOURCES ({len(titles)}):\n")
-        for t in titles: f.write(f"- {t}\n")
-        f.write(f"\nTOTAL CORPUS CHARS (raw/clean): {len(raw)} / {len(corpus)}\n")
-        if warns:
-            f.write("\nWARNINGS:\n")
-            for w in warns: f.write(f"- {w}\n")
+    if DEBUG_COLLECT:
+        await asyncio.to_thread(_write_collect_log, module_ids, pset, fset, aset, titles, warns, len(raw), len(corpus))
     return corpus, warns, titles
 
 # -------------------- Generation --------------------
-def _generate_from_corpus(corpus: str, want: int, default_title: str, system_prompt: str) -> Tuple[str, List[Dict[str, Any]]]:
+LLM_CORPUS_BUDGET = 16000  # chars of corpus sent to the LLM
+_BUDGET_PIECE = 2000  # oversized paragraphs (a whole PDF is one) are ranked in pieces of about this size
+_BUDGET_MIN_TAIL = 200  # smallest truncated piece worth spending the leftover budget on
+
+def _budget_pieces(para: str) -> List[str]:
+    """Cut an oversized paragraph at sentence ends into pieces of roughly _BUDGET_PIECE chars."""
+    if len(para) <= _BUDGET_PIECE:
+        return [para]
+    pieces: List[str] = []
+    start = 0
+    for m in _RE_SENT.finditer(para):
+        if m.start() - start >= _BUDGET_PIECE:
+            pieces.append(para[start:m.start()]); start = m.end()
+    pieces.append(para[start:])
+    return pieces
+
+def _budget_corpus(text: str, budget: int = LLM_CORPUS_BUDGET) -> str:
+    """Greedily keep the most keyword-dense pieces that fit the budget, in original order."""
+    if len(text) <= budget:
+        return text
+    cnt = _keyword_counts(text)
+    pieces = [(pi, piece) for pi, para in enumerate(text.split("\n\n")) for piece in _budget_pieces(para)]
+    # density, not raw sum, so long blocks don't win just for being long
+    density = [sum(cnt[w] for w in _RE_WORD.findall(piece.lower())) / max(len(piece), 1) for _, piece in pieces]
+    keep: Dict[int, str] = {}
+    skipped: List[int] = []
+    used = 0
+    for i in sorted(range(len(pieces)), key=lambda i: -density[i]):
+        cost = len(pieces[i][1]) + 2
+        if used + cost <= budget:
+            keep[i] = pieces[i][1]; used += cost
+        else:
+            skipped.append(i)
+    # spend the leftover on prefixes of the densest pieces that didn't fit, so a
+    # sentence-less block (e.g. PDF text) still reaches the LLM
+    for i in skipped:
+        room = budget - used
+        if room < _BUDGET_MIN_TAIL:
+            break
+        keep[i] = pieces[i][1][:room - 2]; used = budget
+    out: List[str] = []
+    prev = None
+    for i in sorted(keep):
+        if prev is not None:
+            # neighbouring pieces of one paragraph rejoin as prose; gaps become paragraph breaks
+            out.append(" " if i == prev + 1 and pieces[i][0] == pieces[prev][0] else "\n\n")
+        out.append(keep[i]); prev = i
+    return "".join(out)
+
+def _generate_from_corpus(clean: str, want: int, default_title: str, system_prompt: str) -> Tuple[str, List[Dict[str, Any]]]:
+    """`clean` must already be cleaned (_collect_content output or cleaned titles)."""
     # Try LLM first
     try:
-        data = chat_json(system_prompt, f"Create exactly {want} questions grounded ONLY in this text:\n\"\"\"{corpus[:20000]}\"\"\"", max_tokens=2400, temperature=0.15)
+        data = chat_json(system_prompt, f"Create exactly {want} questions grounded ONLY in this text:\n\"\"\"{_budget_corpus(clean)}\"\"\"", max_tokens=2400, temperature=0.15)
         title, packed = _pack_questions(data, default_title=default_title)
+        # _pack_questions already deduped; only a top-up can reintroduce repeats
+        needs_dedup = len(packed) < want
         # If LLM under-delivered, top up with offline
-        if len(packed) < want:
-            packed.extend(_offline_generate(corpus, want - len(packed)))
+        if needs_dedup:
+            packed.extend(_offline_generate(clean, want - len(packed)))
     except Exception:
-        title, packed = default_title, _offline_generate(corpus, want)
-
-    # Deduplicate and clamp
-    seen=set(); ded=[]
-    for q in packed:
-        key=(q.get("type"), (q.get("prompt") or "").strip())
-        if key[1] and key not in seen:
-            seen.add(key); ded.append(q)
-    return (title or default_title), ded[:want]
+        title, packed = default_title, _offline_generate(clean, want)
+        needs_dedup = True  # offline filler questions repeat
+
+    if needs_dedup:
+        packed = _dedup_questions(packed)
+    return (title or default_title), packed[:want]
+
+# -------------------- Publishing --------------------
+_QUIZ_SETTINGS = ("published", "shuffle_answers", "time_limit", "due_at")
+
+def _quiz_fields(title: str, settings: Dict[str, Any]) -> Dict[str, Any]:
+    fields: Dict[str, Any] = {"quiz[title]": title, "quiz[quiz_type]": "assignment"}
+    for k in _QUIZ_SETTINGS:
+        if settings.get(k) is not None:
+            fields[f"quiz[{k}]"] = settings[k]
+    return fields
+
+def _question_fields(q: Question) -> Dict[str, Any]:
+    """Map a validated question model onto Canvas classic-quiz "question[...]" form keys."""
+    fields: Dict[str, Any] = {
+        "question[question_name]": "Question",
+        "question[question_text]": q.prompt,
+        "question[points_possible]": q.points,
+    }
+    answers: List[Tuple[str, int]] = []
+    if isinstance(q, MCQ):
+        fields["question[question_type]"] = "multiple_choice_question"
+        answers = [(c, 100 if i == q.answer else 0) for i, c in enumerate(q.choices)]
+    elif isinstance(q, TrueFalse):
+        fields["question[question_type]"] = "true_false_question"
+        answers = [("True", 100 if q.answer else 0), ("False", 0 if q.answer else 100)]
+    elif isinstance(q, FillBlank):
+        fields["question[question_type]"] = "short_answer_question"
+        answers = [(q.answer, 100)]
+    else:
+        fields["question[question_type]"] = "essay_question"
+    for i, (text, weight) in enumerate(answers):
+        fields[f"question[answers][{i}][answer_text]"] = text
+        fields[f"question[answers][{i}][answer_weight]"] = weight
+    return fields
 
 # -------------------- Endpoints --------------------
 @app.post("/auth")
@@ -432,45 +584,39 @@ async def auth(payload: dict):
     if not token:
         raise HTTPException(status_code=400, detail="canvas_token is required")
 
-    client = CanvasClient(base, token)
+    client = CanvasClient(base, token, http=CANVAS_HTTP)
     try:
         await client.validate_token()
         # also return courses for the UI
         courses = await client.list_courses()
     except CanvasError as e:
         raise HTTPException(status_code=401, detail=str(e))
-    finally:
-        try:
-            await client.close()
-        except Exception:
-            pass
 
-    # store creds in-process (serverless note: ephemeral; UI must send on each call)
-    global _AUTH
-    _AUTH = {"canvas_base_url": base, "canvas_token": token}
+    # nothing is stored server-side; the UI sends creds on each call
 
     # return plain JSON (no pydantic model to avoid serialization surprises)
     return {"ok": True, "canvas_base_url": base, "courses": courses}
 @app.post("/modules")
-def modules(body: ModulesBody):
+async def modules(body: ModulesBody):
     _update_state_if_provided(body.canvas_base_url, body.canvas_token)
     client = _client_or_401()
-    cid = _resolve_course_id(client, body.course_id)
+    cid = await _resolve_course_id(client, body.course_id)
     try:
-        mods = client.list_modules(cid)
-        return {"modules": mods}
+        mods = await client.list_modules(cid)
+        # Returned directly so the raw Canvas payload skips jsonable_encoder
+        return ORJSONResponse({"modules": mods})
     except Exception as e:
         raise HTTPException(status_code=400, detail=f"Canvas error: {e}")
 
 @app.post("/generate/quiz")
-def generate_quiz(body: GenerateQuizBody):
+async def generate_quiz(body: GenerateQuizBody):
     _update_state_if_provided(body.canvas_base_url, body.canvas_token)
     client = _client_or_401()
-    cid = _resolve_course_id(client, body.course_id)
-    corpus, warns, titles = _collect_content(client, cid, body.module_ids, body.page_urls, body.file_ids, body.assignment_ids)
+    cid = await _resolve_course_id(client, body.course_id)
+    corpus, warns, titles = await _collect_content(client, cid, body.module_ids, body.page_urls, body.file_ids, body.assignment_ids)
 
     if not corpus and (body.module_ids or body.page_urls or body.file_ids or body.assignment_ids):
-        corpus = "\n".join(titles)
+        corpus = _cleanup_text("\n".join(titles))
         if corpus:
             warns.append("No Page/File text extracted; fell back to module/item titles.")
 
@@ -478,22 +624,23 @@ def generate_quiz(body: GenerateQuizBody):
         raise HTTPException(status_code=422, detail="No course materials extracted. Select Page/File/Assignment items or tick a module header, then try again.")
 
     want = max(1, int(body.quiz_count or 20))
-    title, packed = _generate_from_corpus(
-        corpus, want, "Generated Quiz",
+    title, packed = await asyncio.to_thread(
+        _generate_from_corpus, corpus, want, "Generated Quiz",
         "You are an exam writer. Only use the provided text. Output strict JSON {title, questions:[...]}. Use mcq,truefalse,short,fillblank. Each item has 'points'."
     )
-    quiz = Quiz(title=(title or "Generated Quiz"), questions=packed)  # type: ignore[arg-type]
-    return {"warnings": warns, "quiz": quiz, "course_id": cid}
+    # packed items are already shaped by _normalize_question; skip a second Pydantic pass
+    quiz = {"title": title or "Generated Quiz", "questions": packed}
+    return ORJSONResponse({"warnings": warns, "quiz": quiz, "course_id": cid})
 
 @app.post("/generate/midterm")
-def generate_midterm(body: GenerateMidtermBody):
+async def generate_midterm(body: GenerateMidtermBody):
     _update_state_if_provided(body.canvas_base_url, body.canvas_token)
     client = _client_or_401()
-    cid = _resolve_course_id(client, body.course_id)
-    corpus, warns, titles = _collect_content(client, cid, body.module_ids, body.page_urls, body.file_ids, body.assignment_ids)
+    cid = await _resolve_course_id(client, body.course_id)
+    corpus, warns, titles = await _collect_content(client, cid, body.module_ids, body.page_urls, body.file_ids, body.assignment_ids)
 
     if not corpus and (body.module_ids or body.page_urls or body.file_ids or body.assignment_ids):
-        corpus = "\n".join(titles)
+        corpus = _cleanup_text("\n".join(titles))
         if corpus:
             warns.append("No Page/File text extracted; fell back to module/item titles.")
 
@@ -501,45 +648,41 @@ def generate_midterm(body: GenerateMidtermBody):
         raise HTTPException(status_code=422, detail="No course materials extracted. Select Page/File/Assignment items or tick a module header, then try again.")
 
     want = 30
-    title, packed = _generate_from_corpus(
-        corpus, want, "Generated Midterm",
+    title, packed = await asyncio.to_thread(
+        _generate_from_corpus, corpus, want, "Generated Midterm",
         "You design midterms strictly from provided text. Output strict JSON {title, questions:[...]}. Include mixed types. Each has 'points'."
     )
-    mid = Midterm(title=(title or "Generated Midterm"), questions=packed)  # type: ignore[arg-type]
-    return {"warnings": warns, "midterm": mid, "course_id": cid}
+    mid = {"title": title or "Generated Midterm", "questions": packed}
+    return ORJSONResponse({"warnings": warns, "midterm": mid, "course_id": cid})
 
 @app.post("/publish/quiz")
-def publish_quiz(body: PublishQuizBody):
+async def publish_quiz(body: PublishQuizBody):
     _update_state_if_provided(body.canvas_base_url, body.canvas_token)
     client = _client_or_401()
-    cid = _resolve_course_id(client, body.course_id)
-    quiz = body.quiz.model_dump()
+    cid = await _resolve_course_id(client, body.course_id)
     settings = body.settings or {}
     try:
-        qres = client.create_quiz(cid, quiz.get("title") or "Generated Quiz", settings)
+        qres = await client.create_quiz(cid, _quiz_fields(body.quiz.title or "Generated Quiz", settings))
         qid = qres.get("id")
         if not qid:
             raise HTTPException(status_code=400, detail=f"Canvas did not return quiz id: {qres}")
-        for q in quiz.get("questions", []):
-            client.create_quiz_question(cid, qid, q)
+        await client.create_quiz_questions(cid, qid, [_question_fields(q) for q in body.quiz.questions])
         return {"quiz_id": qid, "html_url": qres.get("html_url")}
     except Exception as e:
         raise HTTPException(status_code=400, detail=str(e))
 
 @app.post("/publish/midterm")
-def publish_midterm(body: PublishMidtermBody):
+async def publish_midterm(body: PublishMidtermBody):
     _update_state_if_provided(body.canvas_base_url, body.canvas_token)
     client = _client_or_401()
-    cid = _resolve_course_id(client, body.course_id)
-    mid = body.midterm.model_dump()
+    cid = await _resolve_course_id(client, body.course_id)
     settings = body.settings or {}
     try:
-        qres = client.create_quiz(cid, mid.get("title") or "Generated Midterm", settings)
+        qres = await client.create_quiz(cid, _quiz_fields(body.midterm.title or "Generated Midterm", settings))
         qid = qres.get("id")
         if not qid:
             raise HTTPException(status_code=400, detail=f"Canvas did not return quiz id: {qres}")
-        for q in mid.get("questions", []):
-            client.create_quiz_question(cid, qid, q)
+        await client.create_quiz_questions(cid, qid, [_question_fields(q) for q in body.midterm.questions])
         return {"quiz_id": qid, "html_url": qres.get("html_url")}
     except Exception as e:
         raise HTTPException(status_code=400, detail=str(e))
\ No newline at end of file
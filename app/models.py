@@ -1,5 +1,5 @@
 from __future__ import annotations
-from typing import List, Literal, Union
+from typing import Annotated, List, Literal, Union
 from pydantic import BaseModel, Field
 
 class MCQ(BaseModel):
@@ -26,7 +26,8 @@ class FillBlank(BaseModel):
     answer: str
     points: int = 1
 
-Question = Union[MCQ, TrueFalse, Short, FillBlank]
+# Tagged on "type" so validation dispatches straight to one model instead of trying each
+Question = Annotated[Union[MCQ, TrueFalse, Short, FillBlank], Field(discriminator="type")]
 
 class Quiz(BaseModel):
     title: str
@@ -8,4 +8,4 @@ pip install -U pip >/dev/null
 pip install -q -r requirements.txt
 python -m py_compile app/*.py
 echo "Server ready. Opening at http://127.0.0.1:5055 ..."
-uvicorn app.main:app --host 127.0.0.1 --port 5055
+uvicorn app.main:app --host 127.0.0.1 --port 5055 --loop uvloop --http httptools